@@ -0,0 +1,24 @@
+# coding: utf-8
+"""Define the CompiledModel class."""
+
+from keras import backend as K
+
+class CompiledModel:
+    """Wraps a Keras model so that predict_on_batch calls a backend function
+    compiled once, instead of going through Model.predict_on_batch, which
+    checks and converts its input on every call. Use it for the many small
+    predictions made while running episodes."""
+
+    def __init__(self, model):
+        self.model = model
+        self.input_shape = model.input_shape
+        self.output_shape = model.output_shape
+        self._predict = K.function([model.input], model.outputs)
+
+    def predict_on_batch(self, state):
+        """
+        state: B x I
+        """
+        outputs = self._predict([state])
+        # Like Model.predict_on_batch, return a list only for multiple outputs.
+        return outputs[0] if len(outputs) == 1 else outputs
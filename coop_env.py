@@ -184,6 +184,9 @@ class CoopEnv(Env):
     def get_max_accel(self):
         return self._max_accel
 
+    def get_max_steps(self):
+        return self._max_steps
+
 obstacle_list1 = [Obstacle(1.0,.5,0.1)]
 
 register(
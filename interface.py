@@ -27,45 +27,72 @@ def build_nn_input(state, k, l):
 	car_list, obstacle_list = state
 	assert k < len(car_list)
 	assert l <= len(obstacle_list)
-	nn_input = []
-	for this_car in car_list:
-		sorted_car_list = sorted([(this_car.dist(car), car) for car in car_list], key=(lambda x:x[0]))
-		sorted_obstacle_list = sorted([(this_car.dist(obs), obs) for obs in obstacle_list], key=(lambda x:x[0]))
+	num_cars = len(car_list)
+	# Gather the car states into arrays once, and build every car's input from them.
+	pos = np.array([(car.pos_x, car.pos_y) for car in car_list])
+	vel = np.array([(car.vel_x, car.vel_y) for car in car_list])
+	nn_input = np.empty((num_cars, get_nn_input_dim(k, l)), dtype=np.float32)
+	if k > 0:
+		car_dist = np.linalg.norm(pos[None, :] - pos[:, None], axis=2)
 		# Remove the first car, as it should be itself
-		sorted_car_list = [x[1] for x in sorted_car_list[1:k+1]]
-		sorted_obstacle_list = [x[1] for x in sorted_obstacle_list[0:l]]
-		param_list = [[car.pos_x - this_car.pos_x, car.pos_y - this_car.pos_y,
-		car.vel_x - this_car.vel_x, car.vel_y - this_car.vel_y] for car in sorted_car_list]
-		param_list += [[obs.pos_x - this_car.pos_x, obs.pos_y - this_car.pos_y, obs.radius] for obs in sorted_obstacle_list]
-		param_list.append([this_car.pos_x, this_car.pos_y, this_car.vel_x, this_car.vel_y])
-		nn_input.append(np.array(sum(param_list, [])))
-
-	return np.array(nn_input)
+		closest = np.argsort(car_dist, axis=1, kind='stable')[:, 1:k+1]
+		rel_cars = np.concatenate([pos[closest] - pos[:, None], vel[closest] - vel[:, None]], axis=2)
+		nn_input[:, :4*k] = rel_cars.reshape(num_cars, 4*k)
+	if l > 0:
+		obs_pos = np.array([(obs.pos_x, obs.pos_y) for obs in obstacle_list])
+		obs_radius = np.array([obs.radius for obs in obstacle_list])
+		obs_dist = np.linalg.norm(obs_pos[None, :] - pos[:, None], axis=2)
+		closest = np.argsort(obs_dist, axis=1, kind='stable')[:, :l]
+		rel_obs = np.concatenate([obs_pos[closest] - pos[:, None], obs_radius[closest][:, :, None]], axis=2)
+		nn_input[:, 4*k:4*k+3*l] = rel_obs.reshape(num_cars, 3*l)
+	nn_input[:, -4:-2] = pos
+	nn_input[:, -2:] = vel
+	return nn_input
 
 def get_nn_input_dim(k, l):
 		return 4 * k + 3 * l + 4
 
 def clip_output(controls, max_accel):
-	controls_x, controls_y = controls
-	return (np.clip(controls_x, -max_accel, max_accel), np.clip(controls_y, -max_accel, max_accel))
+	"""Clips controls from build_nn_output to [-max_accel, max_accel].
+
+	Returns: (lx, ly), the numpy arrays of controls in the x and y direction
+		that the environment expects.
+	"""
+	clipped = np.clip(controls, -max_accel, max_accel)
+	return (clipped[:, 0], clipped[:, 1])
 
 def build_nn_output(normal_list, std_x=1, std_y=1):
 	"""Returns controls corresponding to neural net output means (using normal distribution).
 	Args:
 		normal_list: numpy array containing [mean_x, mean_y] 2d np arrays specifying mean of control values.
-		max_accel: all controls should be between -max_accel and max_accel.
 		std_x: standard deviation for the x control.
 		std_y: standard deviation for the y control.
 	Returns:
-		(lx, ly): lx is a numpy array of controls in x direction, ly is a numpy array of controls
-			in the y direction. Each control is just a float.
+		A numpy array with the same shape and layout as normal_list, where
+			controls[i] is the [x, y] control for the ith car.
 	"""
 	assert(type(normal_list) == np.ndarray)
 	assert(type(normal_list[0]) == np.ndarray)
 	assert(len(normal_list[0]) == 2)
-	controls_x = [np.random.normal(mean_x, abs(std_x)) for (mean_x, _) in normal_list]
-	controls_y = [np.random.normal(mean_y, abs(std_y)) for (_, mean_y) in normal_list]
-	return (np.array(controls_x), np.array(controls_y))
+	return np.random.normal(normal_list, (abs(std_x), abs(std_y)))
+
+def sample_nn_output_noise(shape, std_x=1, std_y=1, rng=None):
+	"""Draws the noise build_nn_output would add to the means, for many calls at once.
+	Args:
+		shape: shape of the noise for each control, e.g. (num_steps, num_cars).
+		std_x: standard deviation for the x control.
+		std_y: standard deviation for the y control.
+		rng: numpy random Generator to draw from, the global numpy random state if None.
+	Returns:
+		A numpy array of shape shape + (2,), where the last axis is the [x, y] noise.
+	"""
+	if rng is None:
+		rng = np.random
+	return rng.normal(0.0, (abs(std_x), abs(std_y)), size=tuple(shape) + (2,))
+
+def build_nn_output_with_noise(normal_list, noise):
+	"""Returns controls like build_nn_output, but using noise from sample_nn_output_noise."""
+	return normal_list + noise
 
 def build_cnn_input(lists, bot_lane=0, top_lane=1, scale=(4.0, 4.0), size=(40,40)):
 	car_list, obs_list = lists
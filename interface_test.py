@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 from car import Car
 import interface
 
@@ -10,8 +11,8 @@ class TestInterface(unittest.TestCase):
         car = Car(2.0, 3.0, 0.1)
         car2 = Car(4.0, 6.0, 0.1)
         car3 = Car(99.0, 99.0, 0.1)
-        car2.move(2.0, 2.0, 1.0)
-        inarr = interface.build_nn_input([car, car2, car3], 1)
+        car2.move(2.0, 2.0, 1.0, 10.0)
+        inarr = interface.build_nn_input(([car, car2, car3], []), 1, 0)
         self.assertEqual(inarr.shape, (3, 8))
         self.assertEqual(inarr[0][0], 3.0)
         self.assertEqual(inarr[0][1], 4.0)
@@ -22,6 +23,21 @@ class TestInterface(unittest.TestCase):
         self.assertEqual(inarr[1][2], -2.0)
         self.assertEqual(inarr[1][3], -2.0)
 
+    def test_output(self):
+        means = np.array([[0.0, 0.5], [1.0, -1.0]])
+        controls = interface.build_nn_output(means, std_x=0.0, std_y=0.0)
+        self.assertEqual(controls.shape, (2, 2))
+        self.assertTrue(np.allclose(controls, means))
+        controls_x, controls_y = interface.clip_output(controls, 0.75)
+        self.assertTrue(np.allclose(controls_x, [0.0, 0.75]))
+        self.assertTrue(np.allclose(controls_y, [0.5, -0.75]))
+
+        noise = interface.sample_nn_output_noise((3, 2), std_x=0.0, std_y=1.0)
+        self.assertEqual(noise.shape, (3, 2, 2))
+        self.assertTrue(np.all(noise[:, :, 0] == 0.0))
+        controls = interface.build_nn_output_with_noise(means, noise[0])
+        self.assertTrue(np.allclose(controls, means + noise[0]))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -3,12 +3,14 @@ import gym
 import math
 import time
 import interface
-from keras.layers import Dense, Activation, Lambda
+from keras.layers import Dense, Lambda, Input
 
-from keras.models import Sequential
+from keras.models import Model
 from keras import optimizers
+from keras import backend as K
 import numpy as np
 from rolling_stats import RollingStats
+from compiled_model import CompiledModel
 
 # Enable flag to record videos.
 record_flag = 1
@@ -49,25 +51,26 @@ def run_random_policy(env):
 
     return total_reward, num_steps
 
-def run_nn_policy(env, nn, build_state_rep, stddev=1.0, render=False, recorder=None):
+def run_nn_policy(env, nn, build_state_rep, stddev=1.0, render=False, recorder=None, rng=None):
     total_reward = 0
     num_steps = 0
     max_accel = env.get_max_accel()
+    noise = interface.sample_nn_output_noise(
+        (env.get_max_steps(), len(env._cars)), std_x=stddev, std_y=stddev, rng=rng)
     if recorder:
         env = recorder
         record_flag = 1
+    render_mode = "rgb_array" if recorder else "human"
     
     state = env.reset()
     while True:
         state_rep = build_state_rep(state)
         pred = nn.predict_on_batch(state_rep)
-        action = interface.build_nn_output(pred, std_x=stddev, std_y=stddev)
+        action = interface.build_nn_output_with_noise(pred, noise[num_steps])
         clipped_action = interface.clip_output(action, max_accel)
         state, reward, is_terminal, debug_info = env.step(clipped_action)
-        if render and recorder:
-            env.render(mode="rgb_array")
-        elif render:
-            env.render(mode="human")
+        if render:
+            env.render(mode=render_mode)
 
         total_reward += reward
         num_steps += 1
@@ -78,9 +81,53 @@ def run_nn_policy(env, nn, build_state_rep, stddev=1.0, render=False, recorder=N
     record_flag = 0
     return total_reward, num_steps
 
-def run_actor_critic_episode(env, actor, critic, build_state_rep, stddev=1.0, render=True):
+def run_nn_policy_batch(envs, nn, build_state_rep, stddev=1.0, rngs=None):
+    """Run one episode of the policy in each of the given environments.
+
+    The environments are stepped in lockstep, so each time step needs one
+    network call for all the episodes that are still running. All environments
+    must have the same number of cars. rngs optionally gives a numpy random
+    Generator for each environment's policy noise.
+
+    Returns a list of total rewards and a list of step counts, one per episode.
+    """
+    num_envs = len(envs)
+    states = [env.reset() for env in envs]
+    max_accel = envs[0].get_max_accel()
+    if rngs is None:
+        rngs = [None] * num_envs
+    noise = np.stack([interface.sample_nn_output_noise(
+        (envs[0].get_max_steps(), len(envs[0]._cars)), std_x=stddev, std_y=stddev, rng=rng)
+        for rng in rngs])
+    total_rewards = [0] * num_envs
+    num_steps = [0] * num_envs
+    is_running = np.ones(num_envs, dtype=bool)
+    while is_running.any():
+        running = np.flatnonzero(is_running)
+        preds = nn.predict_on_batch(np.concatenate([build_state_rep(states[e]) for e in running]))
+        preds = preds.reshape((len(running), -1) + preds.shape[1:])
+        for e, pred in zip(running, preds):
+            action = interface.build_nn_output_with_noise(pred, noise[e, num_steps[e]])
+            clipped_action = interface.clip_output(action, max_accel)
+            states[e], reward, is_terminal, debug_info = envs[e].step(clipped_action)
+
+            total_rewards[e] += reward
+            num_steps[e] += 1
+            if is_terminal:
+                is_running[e] = False
+
+    return total_rewards, num_steps
+
+def run_actor_critic_episode(env, actor_critic, train_step, build_state_rep, stddev=1.0, render=False,
+                             rng=None):
     """Run one episode of actor-critic with baseline. See page 272 of
-        Sutton and Barto for algorithm."""
+    Sutton and Barto for algorithm.
+
+    actor_critic predicts both the actions and the values of a batch of states,
+    see create_actor_critic_model, so each step needs one call. main() trains
+    with run_monte_carlo_batch and does not use this runner. Its train_step is
+    make_train_step(actor, critic, optimizer), without shared_baseline_cars.
+    rng optionally gives a numpy random Generator for the policy noise."""
     old_state = env.reset()
     if render:
         env.render()
@@ -88,191 +135,278 @@ def run_actor_critic_episode(env, actor, critic, build_state_rep, stddev=1.0, re
     total_reward = 0
     num_steps = 0
     num_cars = len(env._cars)
+    max_accel = env.get_max_accel()
+    var = stddev ** 2
+    # Training pairs for the whole episode, one row per car per step. The
+    # buffers use the backend's float type so feeding them needs no conversion.
+    max_rows = env.get_max_steps() * num_cars
+    noise = interface.sample_nn_output_noise(
+        (env.get_max_steps(), num_cars), std_x=stddev, std_y=stddev, rng=rng)
+    state_batch = np.empty((max_rows,) + actor_critic.input_shape[1:], dtype=K.floatx())
+    critic_targets = np.empty((max_rows, 1), dtype=K.floatx())
+    actions = np.empty((max_rows,) + actor_critic.output_shape[0][1:], dtype=K.floatx())
+    old_state_rep = build_state_rep(old_state)
+    pred, _ = actor_critic.predict_on_batch(old_state_rep)
     while True:
-        old_state_rep = build_state_rep(old_state)
-        pred = actor.predict_on_batch(old_state_rep)
-        action = interface.build_nn_output(pred, std_x=stddev, std_y=stddev)
+        action = interface.build_nn_output_with_noise(pred, noise[num_steps])
 
-        clipped_action = interface.clip_output(action, env.get_max_accel())
+        clipped_action = interface.clip_output(action, max_accel)
         # It's important that we send the clipped action to the environment, but
         # use the unclipped action for reinforce. Otherwise reinforce won't
         # get the correct updates.
         new_state, reward, is_terminal, debug_info = env.step(clipped_action)
 
-        # Train critic
+        # Critic target. The value of the old state, and so the TD error, is
+        # computed inside the train step.
         if is_terminal:
-            next_reward = np.array([[0.0]] * num_cars)
+            next_reward = np.zeros((num_cars, 1))
         else:
             new_state_rep = build_state_rep(new_state)
-            next_reward = critic.predict_on_batch(new_state_rep)
-        for i in range(num_cars):
-            next_reward[i][0] += reward
-        cur_reward = critic.predict_on_batch(old_state_rep)
-        print(cur_reward)
-        delta = next_reward - cur_reward
-        print(delta)
-        critic.train_on_batch(old_state_rep, next_reward)
-        # print num_steps, critic.predict_on_batch(old_state_rep)[0][0]
-
-        # Train actor
-
-        action_t = np.array(action).transpose()
-        target = (action_t - pred) / (stddev ** 2) * delta + pred
-        actor.train_on_batch(old_state_rep, target)
+            # The new state's values, and the next step's means.
+            pred, next_reward = actor_critic.predict_on_batch(new_state_rep)
+        next_reward += reward
+
+        rows = slice(num_steps * num_cars, (num_steps + 1) * num_cars)
+        state_batch[rows] = old_state_rep
+        critic_targets[rows] = next_reward
+        actions[rows] = action
 
         # Render if requested.
         if render:
             env.render()
 
-        # Bookkeeping.
-        old_state = new_state
+        # Bookkeeping. The new state's representation is reused as the next
+        # step's old state representation.
+        if not is_terminal:
+            old_state_rep = new_state_rep
         total_reward += reward
         num_steps += 1
 
         if is_terminal:
             break
+
+    # Train critic and actor on the whole episode.
+    num_rows = num_steps * num_cars
+    train_step([state_batch[:num_rows], actions[:num_rows], critic_targets[:num_rows],
+                critic_targets[:num_rows], var])
     return total_reward, num_steps
 
 
-def run_monte_carlo_episode(env, actor, critic, build_state_rep, stddev=1.0, render=True):
+def run_monte_carlo_episode(env, actor_critic, train_step, build_state_rep, stddev=1.0, render=False):
     """Run one episode of monte carlo reinforce with baseline. See page 271 of
     Sutton and Barto for algorithm."""
-    old_state = env.reset()
-    if render:
-        env.render()
+    total_rewards, num_steps = run_monte_carlo_batch(
+        [env], actor_critic, train_step, build_state_rep, stddev, render)
+    return total_rewards[0], num_steps[0]
 
-    episode = []
-    total_reward = 0
-    num_steps = 0
-    while True:
-        old_state_rep = build_state_rep(old_state)
-        pred = actor.predict_on_batch(old_state_rep)
-        action = interface.build_nn_output(pred, std_x=stddev, std_y=stddev)
-        clipped_action = interface.clip_output(action, env.get_max_accel())
-        # It's important that we send the clipped action to the environment, but
-        # use the unclipped action for reinforce. Otherwise reinforce won't
-        # get the correct updates.
-        new_state, reward, is_terminal, debug_info = env.step(clipped_action)
-        episode.append((old_state_rep, pred, action, reward))
-        num_cars = len(env._cars)
-        # Train critic
-        if is_terminal:
-            next_reward = np.array([[0.0]] * num_cars)
-        else:
-            new_state_rep = build_state_rep(new_state)
-            next_reward = critic.predict_on_batch(new_state_rep)
-        for i in range(num_cars):
-            next_reward[i][0] += reward
-        critic.train_on_batch(old_state_rep, next_reward)
 
-        # Render if requested.
-        if render:
-            env.render()
+def run_monte_carlo_batch(envs, actor_critic, train_step, build_state_rep, stddev=1.0, render=False,
+                          rngs=None):
+    """Run one episode of monte carlo reinforce with baseline in each of the
+    given environments, and train on all of them at once.
 
-        # Bookkeeping.
-        old_state = new_state
-        total_reward += reward
-        num_steps += 1
+    actor_critic predicts both the actions and the values of a batch of states,
+    see create_actor_critic_model. The environments are stepped in lockstep, so
+    each time step needs one call for all the episodes that are still running.
+    All environments must have the same number of cars. If render is set, only
+    the first environment is rendered. rngs optionally gives a numpy random
+    Generator for each environment's policy noise.
 
-        if is_terminal:
-            break
-    
-    Gt = total_reward
-    var = stddev ** 2
-    state_batch = []
-    target_batch = []
-    for state_rep, pred, action, reward in episode:
-        action_t = np.array(action).transpose()
-        critic_reward = critic.predict_on_batch(state_rep)[0][0]
-        target = (action_t - pred)/var * (Gt - critic_reward) + pred
-        state_batch.append(state_rep)
-        target_batch.append(target)
-        Gt -= reward
-    actor.train_on_batch(np.concatenate(state_batch), np.concatenate(target_batch))
-    return total_reward, num_steps
+    Returns a list of total rewards and a list of step counts, one per episode.
+    """
+    num_envs = len(envs)
+    old_states = [env.reset() for env in envs]
+    if render:
+        envs[0].render()
+
+    num_cars = len(envs[0]._cars)
+    max_steps = envs[0].get_max_steps()
+    max_accel = envs[0].get_max_accel()
+    if rngs is None:
+        rngs = [None] * num_envs
+    noise = np.stack([interface.sample_nn_output_noise(
+        (max_steps, num_cars), std_x=stddev, std_y=stddev, rng=rng) for rng in rngs])
+    # Training data for every episode, indexed by episode, step and car, stored
+    # in the backend's float type like the actor-critic buffers.
+    state_batch = np.empty((num_envs, max_steps, num_cars) + actor_critic.input_shape[1:], dtype=K.floatx())
+    actions = np.empty((num_envs, max_steps, num_cars) + actor_critic.output_shape[0][1:], dtype=K.floatx())
+    critic_targets = np.empty((num_envs, max_steps, num_cars, 1), dtype=K.floatx())
+    # Rewards are zero after an episode ends, so returns can be summed over the
+    # whole buffer.
+    rewards = np.zeros((num_envs, max_steps))
+    num_steps = np.zeros(num_envs, dtype=int)
+    is_running = np.ones(num_envs, dtype=bool)
+    t = 0
+    while is_running.any():
+        running = np.flatnonzero(is_running)
+        old_state_reps = [build_state_rep(old_states[e]) for e in running]
+        preds, values = actor_critic.predict_on_batch(np.concatenate(old_state_reps))
+        preds = preds.reshape((len(running), num_cars) + preds.shape[1:])
+        # The critic's target is the reward plus the value of the next state,
+        # which is zero for terminal states. The running episodes' states are
+        # the next states of their previous step.
+        if t > 0:
+            critic_targets[running, t - 1] += values.reshape(-1, num_cars, 1)
+        for e, old_state_rep, pred in zip(running, old_state_reps, preds):
+            env = envs[e]
+            action = interface.build_nn_output_with_noise(pred, noise[e, t])
+            clipped_action = interface.clip_output(action, max_accel)
+            # It's important that we send the clipped action to the environment, but
+            # use the unclipped action for reinforce. Otherwise reinforce won't
+            # get the correct updates.
+            new_state, reward, is_terminal, debug_info = env.step(clipped_action)
+            state_batch[e, t] = old_state_rep
+            actions[e, t] = action
+            rewards[e, t] = reward
+            critic_targets[e, t] = reward
+
+            # Render if requested.
+            if render and e == 0:
+                env.render()
+
+            # Bookkeeping.
+            old_states[e] = new_state
+            num_steps[e] += 1
+            if is_terminal:
+                is_running[e] = False
+        t += 1
+
+    # Train actor and critic on every episode at once, with one row per car
+    # per step.
+    is_valid = np.arange(max_steps) < num_steps[:, None]
+    returns = np.cumsum(rewards[:, ::-1], axis=1)[:, ::-1]
+    train_step([state_batch[is_valid].reshape((-1,) + state_batch.shape[3:]),
+                actions[is_valid].reshape((-1,) + actions.shape[3:]),
+                np.repeat(returns[is_valid], num_cars)[:, None].astype(K.floatx()),
+                critic_targets[is_valid].reshape(-1, 1), stddev ** 2])
+    total_rewards = returns[:, 0]
+    return list(total_rewards), list(num_steps)
 
     
-def create_policy_model(k, l, max_acc):
-    model = Sequential()
-    model.add(Dense(units=8, input_dim = interface.get_nn_input_dim(k,l)))
-    model.add(Activation('relu'))
-    model.add(Dense(units=8))
-    model.add(Activation('relu'))
-    model.add(Dense(units=8))
-    model.add(Activation('relu'))
-    # model.add(Dense(units=2, kernel_initializer='zeros',
-    #     bias_initializer='zeros'))
-    # model.add(Activation('relu'))
-    # model.add(Dense(units=56))
-    # model.add(Activation('relu'))
-    model.add(Dense(units=2))
-    model.add(Activation('tanh'))
-    #rmsprop = optimizers.RMSprop(lr=0.01, clipnorm=10.)
-    model.compile(optimizer='rmsprop', loss='mse')
-    return model
-
-def create_critic_model(k,l):
-    model = Sequential()
-    model.add(Dense(units=12, input_dim = interface.get_nn_input_dim(k,l)))
-    model.add(Activation('relu'))
-    model.add(Dense(units=12))
-    model.add(Activation('relu'))
-    model.add(Dense(units=12))
-    model.add(Activation('relu'))
-    model.add(Dense(units=1))
-    #rmsprop = optimizers.RMSprop(lr=0.01, clipnorm=10.)
-    model.compile(optimizer='rmsprop', loss='mse')
-    return model
-
-def get_test_reward(env, actor, critic, build_state_rep, test_std_dev, num_testing_iterations=50):
+def create_actor_critic_model(k, l):
+    """Create actor and critic models that share their first two hidden layers.
+
+    Returns (actor, critic, actor_critic), where actor_critic outputs both the
+    actor's and the critic's predictions, so the shared layers run once.
+    """
+    states = Input(shape=(interface.get_nn_input_dim(k,l),))
+    features = Dense(units=12, activation='relu')(states)
+    features = Dense(units=12, activation='relu')(features)
+    actions = Dense(units=8, activation='relu')(features)
+    actions = Dense(units=2, activation='tanh')(actions)
+    values = Dense(units=12, activation='relu')(features)
+    values = Dense(units=1)(values)
+    actor = Model(inputs=states, outputs=actions)
+    critic = Model(inputs=states, outputs=values)
+    actor_critic = Model(inputs=states, outputs=[actions, values])
+    return actor, critic, actor_critic
+
+def make_train_step(actor, critic, optimizer, shared_baseline_cars=None):
+    """Compile one update of an actor and critic with a shared input into a
+    single backend function.
+
+    The function takes [states, actions, returns, critic_targets, var], one row
+    per car per step, and returns the actor and critic losses. If
+    shared_baseline_cars is given, every row of a step uses the first car's
+    value as its baseline. Build it once per pair of models.
+    """
+    assert critic.input is actor.input
+    states = actor.input
+    actions = K.placeholder(shape=actor.output_shape)
+    returns = K.placeholder(shape=(None, 1))
+    critic_targets = K.placeholder(shape=(None, 1))
+    var = K.placeholder(shape=())
+
+    pred = actor.output
+    values = critic.output
+    if shared_baseline_cars is None:
+        baselines = values
+    else:
+        baselines = K.repeat_elements(values[::shared_baseline_cars], shared_baseline_cars, axis=0)
+    actor_targets = K.stop_gradient((actions - pred) / var * (returns - baselines) + pred)
+    # Scaling by var cancels the 1/var in the target, so the actor's gradient
+    # does not swamp the critic's on the shared layers.
+    actor_loss = var * K.mean(K.square(actor_targets - pred))
+    critic_loss = K.mean(K.square(critic_targets - values))
+    # Deduplicate the weights shared between actor and critic.
+    params = list({id(w): w for w in actor.trainable_weights + critic.trainable_weights}.values())
+    updates = optimizer.get_updates(loss=actor_loss + critic_loss, params=params)
+    return K.function([states, actions, returns, critic_targets, var],
+                      [actor_loss, critic_loss], updates=updates)
+
+def get_test_reward(envs, actor, critic, build_state_rep, test_std_dev, num_testing_iterations=50,
+                    rngs=None):
+    """Average the total reward and number of steps over num_testing_iterations
+    episodes, run in lockstep len(envs) at a time."""
     ave_reward = 0.0
     ave_steps = 0.0
-    for i in range(num_testing_iterations):
-        total_reward, num_steps = run_nn_policy(env, actor, build_state_rep, test_std_dev, False, None)
-        # print total_reward
-        ave_reward += total_reward
-        ave_steps += num_steps
+    if rngs is None:
+        rngs = [None] * len(envs)
+    for i in range(0, num_testing_iterations, len(envs)):
+        num_envs = min(len(envs), num_testing_iterations - i)
+        total_rewards, num_steps = run_nn_policy_batch(
+            envs[:num_envs], actor, build_state_rep, test_std_dev, rngs[:num_envs])
+        # print total_rewards
+        ave_reward += sum(total_rewards)
+        ave_steps += sum(num_steps)
     ave_reward /= num_testing_iterations
     ave_steps /= num_testing_iterations
     return ave_reward, ave_steps
 
-def record_episode(env, recorder, actor, build_state_rep, std_dev):
-    return run_nn_policy(env, actor, build_state_rep, std_dev, render=True, recorder=recorder)
+def record_episode(env, recorder, actor, build_state_rep, std_dev, rng=None):
+    return run_nn_policy(env, actor, build_state_rep, std_dev, render=True, recorder=recorder, rng=rng)
 
 def main():
     env = gym.make('coop4cars-v0')
     recorder = gym.wrappers.Monitor(env, "videos", video_callable=lambda id: record_flag)
     num_training_iterations = 20000
+    num_envs = 8 # Number of training episodes run in lockstep.
     testing_frequency = 200 # After how many training iterations do we check the testing error?
+    # Testing runs when i is a multiple of testing_frequency, and i steps by num_envs.
+    assert testing_frequency % num_envs == 0
     num_testing_iterations = 50
     k = 0 # Number of closest cars the neural net stores
     l = 0 # Number of closest obstacles the neural net stores
     # Check that k < total number of cars, l <= total number of obstacles
-    
+    envs = [gym.make('coop4cars-v0') for _ in range(num_envs)]
+    test_envs = [gym.make('coop4cars-v0') for _ in range(num_testing_iterations)]
+    # Independent random streams for the policy noise in each environment.
+    seed_seq = np.random.SeedSequence()
+    rngs = [np.random.default_rng(seed) for seed in seed_seq.spawn(num_envs)]
+    test_rngs = [np.random.default_rng(seed) for seed in seed_seq.spawn(num_testing_iterations)]
+    record_rng = np.random.default_rng(seed_seq.spawn(1)[0])
+
     # Initialize actor and critics.
-    actor = create_policy_model(k, l, env.get_max_accel())
-    critic = create_critic_model(k, l)
+    actor, critic, actor_critic = create_actor_critic_model(k, l)
+    train_step = make_train_step(
+        actor, critic, optimizers.RMSprop(), shared_baseline_cars=len(env._cars))
+    # Run the many small predictions through compiled backend functions.
+    actor = CompiledModel(actor)
+    actor_critic = CompiledModel(actor_critic)
 
     # For recording videos
     build_state_rep = lambda state: interface.build_nn_input(state, k, l)
 
-    # Anneal the standard deviation down.
+    # Anneal the standard deviation down. It reaches train_step as an input, so
+    # annealing needs no new train step.
     test_std_dev = 0.00001
     stddev = 0.03
     stddev_delta = 0.000000
     stddev_min = 0.0001
 
-    for i in range(num_training_iterations):
-        total_reward, num_steps = run_monte_carlo_episode(env, actor, critic, build_state_rep, stddev, False)
+    for i in range(0, num_training_iterations, num_envs):
+        total_rewards, num_steps = run_monte_carlo_batch(
+            envs, actor_critic, train_step, build_state_rep, stddev, False, rngs)
         if stddev > stddev_min:
-            stddev -= stddev_delta
+            stddev -= stddev_delta * num_envs
         # Get test error every so often
         if i % testing_frequency == 0:
-            ave_reward, ave_steps = get_test_reward(env, actor, critic, build_state_rep, test_std_dev, 5)
-            record_episode(env, recorder, actor, build_state_rep, test_std_dev)
+            ave_reward, ave_steps = get_test_reward(test_envs, actor, critic, build_state_rep, test_std_dev, 5, test_rngs)
+            record_episode(env, recorder, actor, build_state_rep, test_std_dev, record_rng)
             print(ave_reward, ave_steps, stddev)
             # print model.get_weights()
-    ave_reward, ave_steps = get_test_reward(env, actor, critic, build_state_rep, test_std_dev, 50)
+    ave_reward, ave_steps = get_test_reward(
+        test_envs, actor, critic, build_state_rep, test_std_dev, num_testing_iterations, test_rngs)
     print(ave_reward, ave_steps, stddev)
 
 if __name__ == '__main__':